@@ -1,43 +1,47 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import base64
-import json
+import tempfile
+import threading
+import xxhash
+import msgspec
 import pandas as pd
-import re
-from groq import Groq, AuthenticationError
-from io import StringIO, BytesIO
-
-def get_info_df(df):
-    buffer = StringIO()
-    df.info(buf=buffer)
-    info_str = buffer.getvalue()
-  
-    lines = info_str.split('\n')
-    rows = []
-    for line in lines[5:-2]:  
-        parts = line.split()
-        row = [parts[0], parts[1], " ".join(parts[2:])]
-        rows.append(row)
-
-    info_df = pd.DataFrame(rows, columns=["Index", "Non-Null Count", "Dtype"])
-    return info_df
+from groq import Groq, AuthenticationError, RateLimitError
+from PIL import Image, ImageOps
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-def convert_df_to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=True, sheet_name='Sheet1')
-    processed_data = output.getvalue()
-    return processed_data
+ITEM_COLUMNS = ["Description", "Quantity", "Unit Price", "Total", "Discounted Total", "ProductType"]
+# Quantities stay floating point: weighed goods are sold by the kilo
+ITEM_DTYPES = {"Quantity": "float64", "Unit Price": "float64", "Total": "float64", "Discounted Total": "float64"}
+
+# Receipt schema for the model's JSON. Only the structure is enforced: a receipt
+# needs its list of items, while the values themselves are often strings like
+# "12,50" or "1 234 Ft", so they decode as strings and parse_amounts turns the
+# item amounts into numbers
+class Item(msgspec.Struct):
+    Description: str | int | float | None = None
+    Quantity: float | str | None = 1
+    UnitPrice: float | str | None = msgspec.field(default=None, name="Unit Price")
+    Total: float | str | None = None
+    DiscountedTotal: float | str | None = msgspec.field(default=None, name="Discounted Total")
+    ProductType: str | None = "unknown"
+
+class Receipt(msgspec.Struct):
+    Items: list[Item]
+    Company: str | int | float | None = "Unknown"
+    Date: str | int | float | None = "Unknown"
+    Deduction: float | str | None = 0
+    Total: float | str | None = "Unknown"
 
-@st.cache_data(show_spinner="🔍 Processing receipt...", ttl=3600)
-def process_receipt(image_bytes, api_key, expected_items):
+PROMPT_BASE = """Extract the following receipt details from the provided text response and return them as a structured JSON object. Return only JSON, no extra text or explanations
 
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    prompt_text = """Extract the following receipt details from the provided text response and return them as a structured JSON object. Return only JSON, no extra text or explanations
+   Each image is a separate receipt. Return a JSON array with one object per image, in the same order as the images.
 
    Fields to extract:
     - Company
     - Date
-    - Items (Description, Quantity, Unit Price, Total, Discounted total)
+    - Items (Description, Quantity, Unit Price, Total, Discounted Total, ProductType)
     - Deduction 
     - Total
     - Discounted Total
@@ -46,39 +50,191 @@ def process_receipt(image_bytes, api_key, expected_items):
     The name of the product item is before the price of that item.
     """
 
-    if expected_items > 0:
-        prompt_text += f"""
-    IMPORTANT: There are exactly {expected_items} items in the receipt. 
+PROMPT_SUFFIX = """
+    IMPORTANT: There are exactly {n} items in the receipt. 
     Do not infer or hallucinate additional items. 
-    Return exactly {expected_items} items in the 'Items' field of the JSON.
+    Return exactly {n} items in the 'Items' field of the JSON.
     """
 
-    client = Groq(api_key=api_key)
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=100)
+def convert_df_to_excel(df):
+    # Small workbooks stay in memory, large ones spill to disk
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode='w+b') as output:
+        with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}}) as writer:
+            # constant_memory flushes a row once the next one is started, and
+            # df.to_excel writes column by column, so write whole rows instead
+            worksheet = writer.book.add_worksheet('Sheet1')
+            worksheet.write_row(0, 1, df.columns)
+            # xlsxwriter cannot store NaN/inf as numbers: leave NaN blank and write
+            # inf as text, like to_excel's na_rep/inf_rep defaults
+            cells = df.astype(object).where(df.notna(), None)
+            cells = cells.mask(df.isin([float('inf')]), 'inf').mask(df.isin([float('-inf')]), '-inf')
+            rows = cells.itertuples()
+            for row_number, row in enumerate(rows, start=1):
+                worksheet.write_row(row_number, 0, row)
+        output.seek(0)
+        processed_data = output.read()
+    return processed_data
+
+def downscale_jpeg(image_bytes, max_edge, quality):
+    # exif_transpose keeps phone photos upright once the EXIF data is dropped
+    image = ImageOps.exif_transpose(Image.open(BytesIO(image_bytes)))
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    output = BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+# Cached image functions are keyed on an xxh3 digest of the upload and take the
+# bytes as an underscore argument, which Streamlit leaves out of its own hashing
+def image_digest(image_bytes):
+    return xxhash.xxh3_64_hexdigest(image_bytes)
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=100)
+def thumbnail(digest, _image_bytes):
+    return downscale_jpeg(_image_bytes, 1024, 82)
+
+def b64_stream(fp):
+    # Encode in 57KB blocks (a multiple of 3, so no padding mid-stream)
+    out = bytearray()
+    while True:
+        chunk = fp.read(57 * 1024)
+        if not chunk:
+            break
+        out += base64.b64encode(chunk)
+    return out
+
+# Groq accepts at most 5 images per vision request
+MAX_IMAGES_PER_REQUEST = 5
+MAX_CONCURRENT_REQUESTS = 10
+# The SDK retries rate-limited and failed requests itself, honouring retry-after
+GROQ_MAX_RETRIES = 2
+# Larger images only add vision tokens without making the text more legible
+MODEL_IMAGE_MAX_EDGE = 1568
+
+@st.cache_resource(ttl=3600, max_entries=100)
+def get_groq_client(api_key):
+    return Groq(api_key=api_key, max_retries=GROQ_MAX_RETRIES)
+
+def parse_receipts(result_str, expected_count):
+    # Try the requested array first, then a bare object (the model sometimes answers
+    # a single image that way); text before the JSON may itself contain brackets,
+    # and a bare object's own "Items": [...] can look like a receipt array
+    errors = []
+    for opening, closing, receipts_type in (('[', ']', list[Receipt]), ('{', '}', Receipt)):
+        start = result_str.find(opening)
+        end = result_str.rfind(closing)
+        if start == -1 or end < start:
+            continue
+        try:
+            receipts = msgspec.json.decode(result_str[start:end + 1], type=receipts_type)
+        except msgspec.DecodeError as e:
+            errors.append(e)
+            continue
+        if isinstance(receipts, Receipt):
+            receipts = [receipts]
+        if len(receipts) == expected_count:
+            break
+        errors.append(ValueError(f"Expected {expected_count} receipts, model returned {len(receipts)}."))
+    else:
+        if not errors:
+            raise ValueError("No valid JSON found in model response.")
+        # A schema error is more useful than the other attempt's syntax error
+        validation_errors = [e for e in errors if isinstance(e, msgspec.ValidationError)]
+        raise (validation_errors or errors)[-1]
+
+    # Plain dicts keep st.cache_data's pickled results independent of the script module
+    return msgspec.to_builtins(receipts)
+
+def extract_batch(client, prompt_text, batch):
+    content = [{"type": "text", "text": prompt_text}]
+    for image_bytes in batch:
+        image_jpeg = downscale_jpeg(image_bytes, MODEL_IMAGE_MAX_EDGE, 85)
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": (b"data:image/jpeg;base64," + b64_stream(BytesIO(image_jpeg))).decode('ascii'),
+            },
+        })
+
     response = client.chat.completions.create(
         messages=[
             {
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt_text},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                        },
-                    },
-                ],
+                "content": content,
             }
         ],
         model="meta-llama/llama-4-scout-17b-16e-instruct",
     )
 
-    result_str = response.choices[0].message.content
-    match = re.search(r'\{.*\}', result_str, re.DOTALL)
-    if not match:
-        raise ValueError("No valid JSON found in model response.")
+    return parse_receipts(response.choices[0].message.content, len(batch))
+
+# Errors that only affect the batch they happen in; anything else is a bug
+BATCH_ERRORS = (AuthenticationError, RateLimitError, OSError, ValueError, TypeError)
+
+# Cached per batch, so a failed batch is retried on the next rerun while the
+# batches that succeeded are not sent to Groq again
+@st.cache_data(show_spinner=False, ttl=3600)
+def process_batch(digests, _batch, api_key, prompt_text):
+    return extract_batch(get_groq_client(api_key), prompt_text, _batch)
+
+def process_receipts(digests, images, api_key, expected_items):
+    prompt_text = PROMPT_BASE
+    if expected_items > 0:
+        prompt_text += PROMPT_SUFFIX.format(n=expected_items)
+
+    # Worker threads need the script context to use Streamlit's caches
+    ctx = get_script_run_ctx()
+
+    def run_batch(batch_start):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        batch_end = batch_start + MAX_IMAGES_PER_REQUEST
+        try:
+            return process_batch(digests[batch_start:batch_end], images[batch_start:batch_end], api_key, prompt_text)
+        except BATCH_ERRORS as e:
+            # Every receipt in the batch reports the batch's error
+            return [e] * len(images[batch_start:batch_end])
+
+    batch_starts = range(0, len(images), MAX_IMAGES_PER_REQUEST)
+    with st.spinner("🔍 Processing receipts..."):
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(batch_starts))) as executor:
+            results = executor.map(run_batch, batch_starts)
+            return [receipt for batch_receipts in results for receipt in batch_receipts]
 
-    result_json = json.loads(match.group(0))
-    return result_json
+def describe_error(e):
+    if isinstance(e, AuthenticationError):
+        return "🚫 Invalid API key. Please check your Groq key and try again."
+    if isinstance(e, RateLimitError):
+        return "⏳ Groq rate limit reached. Please wait a moment and try again."
+    if isinstance(e, OSError):
+        return "🚫 An uploaded file could not be read as an image. Please upload a valid JPG or PNG photo."
+    if isinstance(e, msgspec.ValidationError):
+        return f"🚫 Receipt data could not be read ({e}). Please upload a clearer image."
+    return "🚫 Receipt processing failed. Please upload a clearer image."
+
+def parse_amounts(column):
+    # Receipts print amounts like "12,50", "1 234 Ft" or "1.234,50": drop spaces and
+    # unit/currency text, keep only the last separator and use it as the decimal point
+    is_text = column.map(lambda value: isinstance(value, str))
+    text = (column[is_text].astype(str)
+            .str.replace(r'[^\d,.\-]', '', regex=True)
+            .str.replace(r'[.,](?=.*[.,])', '', regex=True)
+            .str.replace(',', '.', regex=False))
+    return pd.to_numeric(column.mask(is_text, text), errors='coerce')
+
+def build_receipt_frames(result_json):
+    items_df = pd.DataFrame.from_records(result_json["Items"], columns=ITEM_COLUMNS)
+    # The model often returns prices as strings; unparsable values become NaN
+    for column, dtype in ITEM_DTYPES.items():
+        items_df[column] = parse_amounts(items_df[column]).astype(dtype)
+    items_df["ProductType"] = items_df["ProductType"].astype("category")
+
+    summary_df = pd.DataFrame([{
+            "Company": result_json["Company"],
+            "Date": result_json["Date"],
+            "Discount" : result_json["Deduction"],
+            "Total": result_json["Total"]
+        }])
+    return summary_df, items_df
 
 
 # --- UI ---
@@ -98,7 +254,7 @@ with st.sidebar:
                 <li>Try adding the expected number of items</li>
                 <li>Upload a clearer or better-cropped photo</li>
                 </ul>
-            <li>📥 Download items list and summary as Excel files</li>
+            <li>📥 Download items list as Excel and summary as CSV</li>
         </ol>
     </div>
     """, unsafe_allow_html=True)
@@ -106,65 +262,82 @@ with st.sidebar:
 st.markdown('<p style="font-size:1.3rem; font-weight:bold;">🔑 Enter your Groq API Key</p>', unsafe_allow_html=True)
 api_key = st.text_input("Groq API Key", type="password", label_visibility="collapsed")
 st.caption("Your key should start with 'gsk_' and be valid for Groq API access.")
+# Catch mistyped keys before spending a round trip on Groq's authentication
+if api_key and not api_key.startswith("gsk_"):
+    st.error("🚫 Key must start with 'gsk_'. Please check your Groq key and try again.")
+    api_key = ""
+elif api_key and len(api_key) < 40:
+    st.error("🚫 Key is too short to be a Groq API key. Please check that it was pasted in full.")
+    api_key = ""
 
 st.markdown('<p style="font-size:1.3rem; font-weight:bold;"></p>', unsafe_allow_html=True)
-st.markdown('<p style="font-size:1.3rem; font-weight:bold;">📤 Upload a receipt image - Make sure your photo is clear and the receipt is well-cropped</p>', unsafe_allow_html=True)
+st.markdown('<p style="font-size:1.3rem; font-weight:bold;">📤 Upload one or more receipt images - Make sure your photos are clear and the receipts are well-cropped</p>', unsafe_allow_html=True)
 
-image_file = st.file_uploader("Upload image", type=["jpg", "jpeg", "png"], label_visibility="collapsed")
+image_files = st.file_uploader("Upload images", type=["jpg", "jpeg", "png"], accept_multiple_files=True, label_visibility="collapsed")
 st.markdown('<p style="font-size:1.3rem; font-weight:bold;"></p>', unsafe_allow_html=True)
 st.markdown('<p style="font-size:1.3rem; font-weight:bold;">🔢 Expected number of items (optional, if data extraction is not correct)</p>', unsafe_allow_html=True)
 
-expected_items = st.number_input("Expected Items", min_value=0, step=1, label_visibility="collapsed")
+# A single count cannot describe several receipts, so it only applies to one upload
+multiple_receipts = len(image_files) > 1
+expected_items = st.number_input("Expected Items", min_value=0, step=1, disabled=multiple_receipts, label_visibility="collapsed")
+if multiple_receipts:
+    st.caption("The expected number of items can only be set when a single receipt is uploaded.")
+    expected_items = 0
 
-if image_file and api_key:
-    st.image(image_file, caption="Uploaded Receipt", use_container_width=True)
+if image_files and api_key:
+    images = tuple(image_file.getvalue() for image_file in image_files)
+    digests = tuple(image_digest(image_bytes) for image_bytes in images)
 
     try:
-        image_bytes = image_file.read()
-        result_json = process_receipt(image_bytes, api_key, expected_items)
-
-        items_df = pd.DataFrame(result_json["Items"])
-        total_without_discount = items_df["Total"].sum()
-        summary_df = pd.DataFrame([{
-                "Company": result_json.get("Company", "Unknown"),
-                "Date": result_json.get("Date", "Unknown"),
-                "Discount" : result_json.get("Deduction", 0),
-                "Total": result_json.get("Total", "Unknown") 
-            }])
-
-        # Display and download logic remains unchanged
-        st.subheader("📋 Summary")
-        st.dataframe(summary_df)
-        st.download_button(
-            label="Download summary as Excel",
-            data=convert_df_to_excel(summary_df),
-            file_name='summary.xlsx',
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-        st.subheader("🛒 Items")
-        st.dataframe(items_df)
-        try:
-            if summary_df["Discount"].values == 0:
-                grouped = items_df.groupby("ProductType")["Total"].sum().reset_index()
-                st.subheader("📊 Termékkategóriák szerinti bontás")
-                st.dataframe(grouped)
-                st.bar_chart(grouped.set_index("ProductType"))
-            else:
-                grouped = items_df.groupby("ProductType")["Discounted Total"].sum().reset_index()
-                st.subheader("📊 Termékkategóriák szerinti bontás")
-                st.dataframe(grouped)
-                st.bar_chart(grouped.set_index("ProductType"))
-        except Exception:
-            st.warning("⚠️ Could not generate chart by Product type")
-
-        st.download_button(
-            label="Download items as Excel",
-            data=convert_df_to_excel(items_df),
-            file_name='items.xlsx',
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-    except AuthenticationError:
-        st.error("🚫 Invalid API key. Please check your Groq key and try again.")
-        st.stop()
-    except (ValueError, TypeError, json.JSONDecodeError) as e:
-        st.error("🚫 Receipt processing failed. Please upload a clearer image.")
+        st.image([thumbnail(digest, image_bytes) for digest, image_bytes in zip(digests, images)], caption=[image_file.name for image_file in image_files], use_container_width=True)
+        receipts = process_receipts(digests, images, api_key, expected_items)
+    except OSError as e:
+        st.error(describe_error(e))
+    else:
+        for index, (image_file, result_json) in enumerate(zip(image_files, receipts)):
+            name = image_file.name.rsplit('.', 1)[0]
+            if multiple_receipts:
+                st.header(f"🧾 {image_file.name}")
+
+            if isinstance(result_json, Exception):
+                st.error(describe_error(result_json))
+                continue
+
+            # A malformed receipt only hides its own section, not the other uploads
+            try:
+                summary_df, items_df = build_receipt_frames(result_json)
+            except (KeyError, ValueError, TypeError) as e:
+                st.error(describe_error(e))
+                continue
+
+            st.subheader("📋 Summary")
+            st.dataframe(summary_df)
+            st.download_button(
+                label="Download summary as CSV",
+                data=summary_df.to_csv(index=False).encode('utf-8-sig'),
+                file_name=f'{name}_summary.csv',
+                mime='text/csv',
+                key=f'summary_{index}')
+
+            st.subheader("🛒 Items")
+            st.dataframe(items_df)
+            try:
+                if summary_df["Discount"].values == 0:
+                    grouped = items_df.groupby("ProductType", observed=True)["Total"].sum().reset_index()
+                    st.subheader("📊 Termékkategóriák szerinti bontás")
+                    st.dataframe(grouped)
+                    st.bar_chart(grouped.set_index("ProductType"))
+                else:
+                    grouped = items_df.groupby("ProductType", observed=True)["Discounted Total"].sum().reset_index()
+                    st.subheader("📊 Termékkategóriák szerinti bontás")
+                    st.dataframe(grouped)
+                    st.bar_chart(grouped.set_index("ProductType"))
+            except Exception:
+                st.warning("⚠️ Could not generate chart by Product type")
+
+            st.download_button(
+                label="Download items as Excel",
+                data=convert_df_to_excel(items_df),
+                file_name=f'{name}_items.xlsx',
+                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                key=f'items_{index}')